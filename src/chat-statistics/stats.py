@@ -1,50 +1,214 @@
-import json
-from collections import defaultdict
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+from collections import Counter
+from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import List, Union
+from typing import Any, Callable, Iterator, List, Tuple, Union
 
 import arabic_reshaper
-from hazm import Normalizer, word_tokenize
+import ijson
+from hazm import Normalizer
 from loguru import logger
 from src.data import DATA_DIR
-from wordcloud import WordCloud
+from src.utils.io import iter_lines
+from wordcloud import STOPWORDS, WordCloud
+from wordcloud.tokenization import process_tokens
+
+# normalizer and stop words are shared by every ChatStatistics instance
+_NORMALIZER = Normalizer()
+
+logger.info(f"Loading stopwords from {DATA_DIR / 'stopwords.txt'}")
+_STOP_WORDS = frozenset(
+    _NORMALIZER.normalize(word)
+    for line in iter_lines(DATA_DIR / 'stopwords.txt')
+    for word in line.split()
+) | STOPWORDS
+
+# bump whenever tokenization changes so cached statistics are recomputed
+_CACHE_VERSION = 3
+
+# loading a pickle can run code, so the cache lives in a directory owned by
+# the user instead of next to a possibly shared chat export
+_CACHE_DIR = Path(
+    os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+) / 'telegram_statistics'
+
+# words are runs of word characters; zero width non-joiners are kept inside
+# words since they are part of persian words
+_TOKEN_RE = re.compile(r'\w+(?:\u200c\w+)*')
+
+
+# chats repeat short texts a lot, so memoize processing per text
+@lru_cache(maxsize=100_000)
+def _tokenize(text: str) -> Tuple[str, ...]:
+    """Filters and normalizes input text into tokens, kept at module level so
+    it can be sent to worker processes
+
+    :param text: input text to be processed
+    :return: normalized tokens
+    """
+    # normalize before tokenizing so tokens match the normalized stop words
+    tokens = _TOKEN_RE.findall(_NORMALIZER.normalize(text))
+    # drop what WordCloud would have dropped from raw text: numbers and
+    # (case insensitive) stop words
+    return tuple(
+        token for token in tokens
+        if not token.isdigit() and token.lower() not in _STOP_WORDS
+    )
 
 
 class ChatStatistics:
     """Generates chat word cloud from a telegram chat json file.
     """
 
-    def __init__(self, chat_json: Union[str, Path]) -> None:
+    # latin and arabic question marks
+    _QUESTION_RE = re.compile('[?\u061F]')
+
+    # messages are tokenized in batches of this size to keep memory bounded
+    _BATCH_SIZE = 50_000
+
+    # below this many distinct texts in a batch starting a process pool costs
+    # more than it saves
+    _PARALLEL_MIN_TEXTS = 10_000
+
+    def __init__(self,
+                 chat_json: Union[str, Path],
+                 use_cache: bool = True) -> None:
         """
         :param chat_json: telegram chat json file
+        :param use_cache: reuse statistics pickled in the user cache
+            directory, defaults to True
         """
-        logger.info(f"Loading chat data from {chat_json}")
-        # load chat data
-        with open(chat_json, 'r') as f:
-            self.chat_data = json.load(f)
+        # chat data is streamed lazily, see _iter_messages
+        self.chat_json = Path(chat_json)
 
-        self.normalizer = Normalizer()
+        self.normalizer = _NORMALIZER
+        self.stop_words = _STOP_WORDS
+
+        # computed statistics, persisted while the chat file, stop words and
+        # tokenization are unchanged
+        self.use_cache = use_cache
+        chat_id = str(self.chat_json.resolve()).encode('utf-8')
+        cache_name = f"{hashlib.sha1(chat_id).hexdigest()}.pkl"
+        self.cache_path = _CACHE_DIR / cache_name
+        self._cache = self._load_cache() if use_cache else {}
+
+    def _cache_key(self) -> tuple:
+        """Identifies the current version of the computed statistics
+
+        :return: cache format version, stop words fingerprint and
+            modification time and size of the chat file
+        """
+        stop_words = '\n'.join(sorted(self.stop_words)).encode('utf-8')
+        stat = self.chat_json.stat()
+        return (
+            _CACHE_VERSION,
+            hashlib.sha1(stop_words).hexdigest(),
+            stat.st_mtime_ns,
+            stat.st_size,
+        )
 
-        # load stopwords
-        logger.info(f"Loading stopwords from {DATA_DIR / 'stopwords.txt'}")
-        stop_words = open(DATA_DIR / 'stopwords.txt').readlines()
-        stop_words = map(str.strip, stop_words)
-        self.stop_words = set(map(self.normalizer.normalize, stop_words))
+    def _load_cache(self) -> dict:
+        """Loads cached statistics if they belong to the current chat file
+
+        :return: cached statistics, empty if missing or stale
+        """
+        if not self.cache_path.exists():
+            return {}
+
+        # pickle.load and unpacking a foreign file can fail in many ways, any
+        # of them just means the cache is not usable
+        try:
+            with open(self.cache_path, 'rb') as f:
+                # never unpickle a file someone else could have planted
+                if (hasattr(os, 'getuid')
+                        and os.fstat(f.fileno()).st_uid != os.getuid()):
+                    raise PermissionError('cache is not owned by the user')
+                cache_key, stats = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache {self.cache_path}: {e}")
+            return {}
+
+        if not isinstance(stats, dict) or cache_key != self._cache_key():
+            logger.info(f"Ignoring stale cache {self.cache_path}")
+            return {}
+
+        logger.info(f"Loaded cached statistics from {self.cache_path}")
+        return stats
+
+    def _cached(self, name: str, compute: Callable[[], Any]) -> Any:
+        """Returns a cached statistic, computing and persisting it if needed
+
+        :param name: name of the statistic
+        :param compute: function computing the statistic from chat data
+        :return: statistic value
+        """
+        if name not in self._cache:
+            self._cache[name] = compute()
+            if self.use_cache:
+                self._save_cache()
+        return self._cache[name]
+
+    def _save_cache(self) -> None:
+        """Persists computed statistics, a failed write only costs the cache
+        """
+        logger.info(f"Saving statistics cache to {self.cache_path}")
+        tmp_path = None
+        try:
+            self.cache_path.parent.mkdir(
+                mode=0o700, parents=True, exist_ok=True)
+            # write to a temporary file first so an interrupted run can not
+            # leave a truncated cache behind
+            with tempfile.NamedTemporaryFile(
+                    'wb', dir=self.cache_path.parent, delete=False) as f:
+                tmp_path = f.name
+                pickle.dump((self._cache_key(), self._cache), f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Could not save cache {self.cache_path}: {e}")
+            if tmp_path is not None:
+                with suppress(OSError):
+                    os.unlink(tmp_path)
+
+    def _iter_messages(self) -> Iterator[dict]:
+        """Streams chat messages one at a time without loading the whole file
+
+        :return: iterator over chat messages
+        """
+        logger.info(f"Streaming chat data from {self.chat_json}")
+        with open(self.chat_json, 'rb') as f:
+            yield from ijson.items(f, 'messages.item')
 
     @staticmethod
-    def rebuild_msg(msg: list) -> str:
+    def _iter_fragments(msg: Union[str, list]) -> Iterator[str]:
+        """Yields text fragments of input message
+
+        :param msg: input message, plain text or list of text fragments
+        :return: iterator over text fragments
+        """
+        if isinstance(msg, str):
+            yield msg
+            return
+
+        for sub_msg in msg:
+            yield sub_msg['text'] if isinstance(sub_msg, dict) else sub_msg
+
+    @classmethod
+    def rebuild_msg(cls, msg: Union[str, list]) -> str:
         """Rebuilds input message
 
-        :param msg: input message
+        :param msg: input message, plain text or list of text fragments
         :return: rebuilded message
         """
-        msg_text = ''
-        for sub_msg in msg:
-            if isinstance(sub_msg, dict):
-                msg_text += sub_msg['text'] + " "
-            else:
-                msg_text += sub_msg + " "
-        return msg_text
+        # fragments already carry their own spacing, concatenating them gives
+        # back the original text
+        return ''.join(cls._iter_fragments(msg))
 
     def msg_has_question(self, msg: dict) -> bool:
         """Checks if a message has a question
@@ -52,53 +216,57 @@ class ChatStatistics:
         :param msg: message to check
         :return: True if message has question, False else
         """
-        text = ''
-        if isinstance(msg['text'], str):
-            text = msg['text']
+        # check fragments one by one to stop at the first question mark
+        return any(
+            self._QUESTION_RE.search(fragment)
+            for fragment in self._iter_fragments(msg['text'])
+        )
 
-        elif isinstance(msg['text'], list):
-            text = self.rebuild_msg(msg['text'])
-
-        if '?' in text or '؟' in text:
-            return True
-        return False
-
-    def get_top_users(self, top_n: int = 10) -> List[tuple]:
-        """Get top users from chat data
+    def _count_user_replies(self) -> Tuple[Counter, dict]:
+        """Counts replies of users to questions of others
 
-        :param top_n: numbers of top users, defaults to 10
-        :return: users and number of replies as a tuple
+        :return: reply counts and names, both keyed by user id
         """
-        # creating mapping to check which messages are questions
-        is_question = defaultdict(bool)
-        users = {}
-        for msg in self.chat_data['messages']:
-            is_question[msg['id']] = self.msg_has_question(msg)
+        # ids of messages that are questions, filled in the same pass since
+        # exports are chronological and replies follow questions
+        question_ids = set()
+        counts = Counter()
+        names = {}
 
         # Getting top users based on replying to questions by others
         logger.info('Getting top users of chat data...')
-        for msg in self.chat_data['messages']:
+        for msg in self._iter_messages():
+            if self.msg_has_question(msg):
+                question_ids.add(msg['id'])
             if not msg.get('reply_to_message_id'):
                 continue
 
-            if msg['from_id'] in users.keys():
-                users[msg['from_id']]['replies'].append(
-                    msg['reply_to_message_id'])
+            if msg['reply_to_message_id'] in question_ids:
+                counts[msg['from_id']] += 1
+                names.setdefault(msg['from_id'], msg['from'])
+        return counts, names
 
-            elif is_question[msg['reply_to_message_id']]:
-                users[msg['from_id']] = {
-                    'name': msg['from'],
-                    'replies': [msg['reply_to_message_id']]
-                }
+    def get_top_users(self, top_n: int = 10) -> List[tuple]:
+        """Get top users from chat data
+
+        :param top_n: numbers of top users, defaults to 10
+        :return: users and number of replies as a tuple
+        """
+        counts, names = self._cached('reply_counts', self._count_user_replies)
 
         logger.info('Calculating users with most replies to questions...')
-        reply_conut = [(k, len(v['replies'])) for k, v in users.items()]
-        users_with_most_replies = [
-            (users[user[0]]['name'], user[1]) for user in sorted(
-                reply_conut, key=lambda x: x[1], reverse=True
-            )
+        return [
+            (names[user_id], count)
+            for user_id, count in counts.most_common(top_n)
         ]
-        return users_with_most_replies[:top_n]
+
+    def tokenize(self, text: str) -> Tuple[str, ...]:
+        """Filters and normalizes input text into tokens
+
+        :param text: input text to be processed
+        :return: normalized tokens
+        """
+        return _tokenize(text)
 
     def process_text(self, text: str) -> str:
         """Filters and normalizes input text
@@ -106,11 +274,62 @@ class ChatStatistics:
         :param text: input text to be processed
         :return: processed text
         """
-        tokens = word_tokenize(text)
-        content = ' '.join(
-            list(filter(lambda item: item not in self.stop_words, tokens)))
-        content = self.normalizer.normalize(content)
-        return content
+        return ' '.join(self.tokenize(text))
+
+    def _iter_text_batches(self) -> Iterator[List[str]]:
+        """Streams rebuilt message texts in batches of _BATCH_SIZE
+
+        :return: iterator over batches of texts
+        """
+        texts = (
+            self.rebuild_msg(msg['text']) for msg in self._iter_messages()
+            if isinstance(msg['text'], (str, list))
+        )
+        while True:
+            batch = list(islice(texts, self._BATCH_SIZE))
+            if not batch:
+                return
+            yield batch
+
+    def _iter_tokens(self) -> Iterator[str]:
+        """Streams normalized tokens of all chat messages batch by batch,
+        moving to a process pool once a batch has enough distinct texts and
+        more than one cpu is available
+
+        :return: iterator over tokens
+        """
+        executor = None
+        n_texts = n_unique = 0
+        try:
+            for batch in self._iter_text_batches():
+                # only tokenize each distinct text of a batch once
+                unique_texts = list(dict.fromkeys(batch))
+                n_texts += len(batch)
+                n_unique += len(unique_texts)
+
+                if (executor is None
+                        and (os.cpu_count() or 1) > 1
+                        and len(unique_texts) >= self._PARALLEL_MIN_TEXTS):
+                    logger.info('Starting process pool for tokenization...')
+                    executor = ProcessPoolExecutor()
+
+                if executor is None:
+                    tokens = map(_tokenize, unique_texts)
+                else:
+                    tokens = executor.map(
+                        _tokenize, unique_texts, chunksize=1000)
+                tokenized = dict(zip(unique_texts, tokens))
+
+                for text in batch:
+                    yield from tokenized[text]
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        logger.info(
+            f"Tokenized {n_unique} distinct texts out of {n_texts}, "
+            f"in-process tokenize cache: {_tokenize.cache_info()}"
+        )
 
     def generate_word_cloud(self,
                             output_dir: Union[str, Path],
@@ -123,23 +342,15 @@ class ChatStatistics:
         :param output_dir: path to output directory for word cloud image
         """
 
-        # append all texts in text_content
+        # count tokens, then reshape each distinct word once
         logger.info('Loading text content...')
-        text_content = ''
-        for msg in self.chat_data['messages']:
-            text = ''
-            if isinstance(msg['text'], str):
-                text = msg['text']
-                content = self.process_text(text)
-                text_content += f" {content}"
-
-            elif isinstance(msg['text'], list):
-                text = self.rebuild_msg(msg['text'])
-                content = self.process_text(text)
-                text_content += f" {content}"
-
-        # reshape final word cloud
-        text_content = arabic_reshaper.reshape(text_content)
+        token_counts = self._cached(
+            'token_counts', lambda: Counter(self._iter_tokens()))
+        # merge case variants and plurals like WordCloud.generate would
+        word_counts, _ = process_tokens(token_counts.elements())
+        frequencies = Counter()
+        for token, count in word_counts.items():
+            frequencies[arabic_reshaper.reshape(token)] += count
 
         logger.info('Generating word cloud...')
         # generate word cloud
@@ -147,7 +358,7 @@ class ChatStatistics:
             width=width, height=height,
             font_path=str(DATA_DIR / 'Vazir.ttf'),
             background_color=background_color
-        ).generate(text_content)
+        ).generate_from_frequencies(frequencies)
 
         logger.info(f"Saving word cloud to {output_dir}")
         wordcloud.to_file(Path(output_dir) / 'wordclound.png')
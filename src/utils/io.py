@@ -1,6 +1,11 @@
 import json
 from pathlib import Path
-from typing import Union
+from typing import Iterator, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def read_json(file_path: Union[str, Path]) -> dict:
@@ -9,6 +14,10 @@ def read_json(file_path: Union[str, Path]) -> dict:
     :param file_path: path to json file directory
     :return: dictionary of json file
     """
+    # orjson parses much faster, the stdlib parser is kept as a fallback
+    if orjson is not None:
+        return orjson.loads(Path(file_path).read_bytes())
+
     with open(file_path) as f:
         return json.load(f)
 
@@ -21,3 +30,13 @@ def read_file(file_path: Union[str, Path]) -> str:
     """
     with open(file_path) as f:
         return f.read()
+
+
+def iter_lines(file_path: Union[str, Path]) -> Iterator[str]:
+    """Reads a file lazily, line by line
+
+    :param file_path: path to file directory
+    :return: iterator over lines of the file without trailing newlines
+    """
+    with open(file_path, encoding='utf-8') as f:
+        yield from (line.rstrip('\n') for line in f)